@@ -1,9 +1,28 @@
 import streamlit as st
 import os
-import sqlite3
-import ollama
+import duckdb
+import contextlib
+import dbm
+import hashlib
+import json
+import queue
+import shelve
+import string
+import threading
+import time
+from collections import OrderedDict
+from openai import OpenAI
 import pandas as pd
-import re # <-- NEW: Import the regex module
+import re
+import sqlglot
+from sqlglot import exp
+from sqlglot.optimizer.annotate_types import annotate_types
+from sqlglot.optimizer.qualify import qualify
+
+try:
+    import hyperscan  # Optional (x86-64 only): SIMD keyword scan in _find_sql_start
+except ImportError:
+    hyperscan = None
 
 # --- Streamlit Page Configuration ---
 st.set_page_config(page_title="NL2SQL with Qwen3:8B", layout="centered")
@@ -19,177 +38,810 @@ CREATE TABLE products (
 );
 """
 
+# --- Static System Prompt: instructions + schema ---
+# Kept byte-identical across calls and placed before the question, so the server can reuse
+# the KV-cache for this prefix and only prefill the question on each request.
+# "/no_think" switches off Qwen3's reasoning mode so no <think> tokens are decoded.
+SQL_SYSTEM_INSTRUCTIONS = """/no_think
+You are an expert SQL generator.
+Your ONLY task is to convert natural language questions into accurate SQL queries.
+You MUST respond with *only* the SQL query.
+Do NOT include any explanations, internal thoughts, conversational text, markdown formatting (like ```sql), or any other text before or after the SQL.
+Your response should be *solely* the SQL query.
+
+Here is the database schema:
+"""
+
+# A module constant passed by reference to every request: no per-call concatenation, and the bytes never drift
+SYSTEM_PROMPT_WITH_SCHEMA = SQL_SYSTEM_INSTRUCTIONS + DB_SCHEMA_PRODUCTS
+
 # --- 2. Local Database File Path ---
 DB_FILE = 'products.db'
 DB_PATH = os.path.join(os.getcwd(), DB_FILE)
 
-# --- 3. Function to Generate SQL using Qwen3:8B via Ollama ---
-def generate_sql_qwen(natural_language_query: str, db_schema: str) -> str:
+# --- Persistent cache of generated SQL, keyed by request path, model, prompt, options, schema and question ---
+SQL_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "nl2sql.db")
+CACHE_TTL_SECONDS = 3600
+
+def _cache_key(natural_language_query: str, path: str = 'single') -> str:
+    # hashlib rather than hash(): the key has to be stable across interpreter runs.
+    # Everything that changes the model's answer is part of the key, so switching the model,
+    # the instructions, the schema or the decoding options never serves SQL generated under the old ones.
+    # `path` tells the single-question request from the batch one ('batch'), which uses its
+    # own prompt, JSON mode and token budget.
+    parts = (path, LLM_MODEL, SYSTEM_PROMPT_WITH_SCHEMA, repr(_LLM_OPTIONS), natural_language_query)
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+SQL_MEMORY_CACHE_SIZE = 512
+
+@st.cache_resource
+def _sql_memory_cache() -> OrderedDict[str, tuple[float, str]]:
     """
-    Generates a SQL query from a natural language query using Qwen3:8B via Ollama.
-    Includes stronger prompt engineering and robust post-processing to extract only SQL.
+    In-process copy of the SQL cache, shared by all sessions of this server process,
+    so repeated questions skip the shelve file as well as the LLM. Kept in least-recently-used
+    order and capped at SQL_MEMORY_CACHE_SIZE entries.
+
+    Returns:
+        OrderedDict[str, tuple[float, str]]: Cache key -> (expires_at, sql).
+    """
+    return OrderedDict()
+
+@st.cache_resource
+def _sql_cache_lock() -> threading.Lock:
+    """
+    Serializes access to the shelve file and the in-process copy across all sessions of
+    this server process. A module-level lock would be rebuilt on every rerun and never shared.
+
+    Returns:
+        threading.Lock: The lock held around every shelve.open of SQL_CACHE_PATH.
+    """
+    return threading.Lock()
+
+def _is_live(entry, now: float) -> bool:
+    # Entries are (expires_at, sql); anything else is treated as expired
+    return isinstance(entry, tuple) and len(entry) == 2 and entry[0] >= now
+
+def _remember_sql(key: str, entry: tuple[float, str]) -> None:
+    memory = _sql_memory_cache()
+    with _sql_cache_lock():
+        memory[key] = entry
+        memory.move_to_end(key)
+        while len(memory) > SQL_MEMORY_CACHE_SIZE:
+            memory.popitem(last=False)
+
+def _load_cached_sql(key: str) -> str | None:
+    memory = _sql_memory_cache()
+    with _sql_cache_lock():
+        entry = memory.get(key)
+        if entry is not None:
+            if not _is_live(entry, time.time()):
+                del memory[key]
+                return None
+            memory.move_to_end(key)
+            return entry[1]
+    try:
+        with _sql_cache_lock(), shelve.open(SQL_CACHE_PATH, flag='r') as cache:
+            entry = cache.get(key)
+    except (OSError, *dbm.error):
+        # Missing or unreadable cache file is just a cache miss
+        return None
+    if not _is_live(entry, time.time()):
+        return None
+    _remember_sql(key, entry)
+    return entry[1]
+
+def _store_cached_sql(key: str, sql: str) -> None:
+    try:
+        validate_read_only_sql(sql)
+    except (ValueError, sqlglot.errors.SqlglotError):
+        # Only SQL that would be allowed to run is kept
+        return
+    now = time.time()
+    entry = (now + CACHE_TTL_SECONDS, sql)
+    _remember_sql(key, entry)
+    try:
+        os.makedirs(os.path.dirname(SQL_CACHE_PATH), exist_ok=True)
+        with _sql_cache_lock(), shelve.open(SQL_CACHE_PATH) as cache:
+            # Writes only follow an LLM call, so pruning expired entries here is cheap by comparison
+            for stale in [k for k in cache.keys() if not _is_live(cache[k], now)]:
+                del cache[stale]
+            cache[key] = entry
+    except (OSError, *dbm.error):
+        pass
+
+def clear_sql_cache() -> None:
+    """
+    Empties the on-disk SQL cache and the in-process copy of it.
+    """
+    with _sql_cache_lock():
+        _sql_memory_cache().clear()
+    try:
+        os.makedirs(os.path.dirname(SQL_CACHE_PATH), exist_ok=True)
+        with _sql_cache_lock(), shelve.open(SQL_CACHE_PATH, flag='n'):
+            pass
+    except (OSError, *dbm.error):
+        pass
+
+# --- LLM Server (OpenAI-compatible llama.cpp `llama-server`) ---
+# Start with: ./llama-server -m qwen3-8b-q4_k_m.gguf -c 4096 --parallel 4 --cont-batching
+# Any other OpenAI-compatible endpoint can be used by overriding the two variables below,
+# e.g. Ollama (NL2SQL_LLM_BASE_URL=http://localhost:11434/v1) serving the Q4_K_M model
+# built from the Modelfile: `ollama create qwen3-sql -f Modelfile --quantize q4_K_M`.
+# llama-server serves a single model and ignores the model name.
+LLM_BASE_URL = os.environ.get("NL2SQL_LLM_BASE_URL", "http://localhost:8080/v1")
+LLM_MODEL = os.environ.get("NL2SQL_LLM_MODEL", "qwen3-sql")
+
+@st.cache_resource
+def get_client() -> OpenAI:
+    """
+    Creates the OpenAI-compatible client once per server process, so every rerun and session
+    shares one HTTP connection pool and keep-alive connections to llama-server are reused.
+
+    Returns:
+        OpenAI: The shared client for LLM_BASE_URL.
+    """
+    return OpenAI(base_url=LLM_BASE_URL, api_key="none")
+
+@st.cache_resource
+def _warm_llm() -> threading.Thread:
+    """
+    Sends a one-token request once per server process so the model weights (and the KV-cache
+    for the shared system prompt) are in memory before the first real question. Runs in a
+    background thread so the first page render is not blocked.
+    With Ollama, also set OLLAMA_KEEP_ALIVE=-1 so the model is never unloaded afterwards.
+
+    Returns:
+        threading.Thread: The warm-up thread.
+    """
+    # Looked up on the script thread; the warm-up thread only uses it
+    llm = get_client()
+
+    def warm() -> None:
+        try:
+            llm.chat.completions.create(
+                model=LLM_MODEL,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT_WITH_SCHEMA},
+                    {"role": "user", "content": "ok"}
+                ],
+                max_tokens=1,
+            )
+        except Exception:
+            # The server may not be up yet; the first real request reports any error
+            pass
+
+    thread = threading.Thread(target=warm, name="llm-warmup", daemon=True)
+    thread.start()
+    return thread
+
+_warm_llm()
+
+# --- Decoding options: greedy and bounded, SQL answers are short ---
+# The server stops at the first ';' and strips it; _extract_sql puts it back.
+_LLM_OPTIONS = {'max_tokens': 128, 'temperature': 0.0, 'stop': [';'], 'extra_body': {'top_k': 1}}
+
+# --- SQL post-processing helpers ---
+# Only queries that validate_read_only_sql lets through; DML/DDL would be refused anyway
+_SQL_KW = ('select', 'with')
+# Keywords that may also start the SQL mid-line. "with" (like "create", "drop", ...) is an
+# everyday English word, so prose such as "answer with a query:" must not match it
+_INLINE_SQL_KW = ('select',)
+# What may precede a keyword on its line for it to count as the start of the SQL
+_LINE_PREFIXES = ('', '```', '```sql', 'sql:')
+
+# ASCII-only lower-casing: keeps str indices aligned and matches Hyperscan's ASCII-only caseless mode
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+@st.cache_resource
+def _keyword_database():
+    """
+    Compiles all SQL keywords into one Hyperscan block-mode database, once per server process.
+
+    Returns:
+        tuple[hyperscan.Database, hyperscan.Scratch, queue.SimpleQueue] | None: The compiled
+            database, a template scratch and the pool of idle scratches cloned from it,
+            or None if hyperscan is not installed.
+    """
+    if hyperscan is None:
+        return None
+    # Ids below len(_SQL_KW) are keywords at the start of a line, the rest inline keywords.
+    # Every pattern ends with the keyword and one whitespace byte, so the keyword's offset
+    # follows from the match end and start-of-match tracking is not needed.
+    anchored = [rb'^[ \t]*(?:```(?:sql)?|sql:)?[ \t]*\b' + kw.encode() + rb'\s' for kw in _SQL_KW]
+    inline = [rb'\b' + kw.encode() + rb'\s' for kw in _INLINE_SQL_KW]
+    db = hyperscan.Database()
+    db.compile(
+        expressions=anchored + inline,
+        ids=list(range(len(anchored) + len(inline))),
+        elements=len(anchored) + len(inline),
+        flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_MULTILINE] * len(anchored)
+              + [hyperscan.HS_FLAG_CASELESS] * len(inline),
+    )
+    return db, hyperscan.Scratch(db), queue.SimpleQueue()
+
+_KW_DB = _keyword_database()
+
+@contextlib.contextmanager
+def _keyword_scratch():
+    """
+    Lends out an idle Hyperscan scratch from the pool, cloning the template only when all are
+    in use. A scratch can only be used by one scan at a time, so concurrent sessions need their
+    own; the pool outlives reruns, and Streamlit runs each rerun on a new thread, so
+    per-thread scratches would be cloned again on every run.
+    """
+    try:
+        scratch = _KW_DB[2].get_nowait()
+    except queue.Empty:
+        scratch = _KW_DB[1].clone()
+    try:
+        yield scratch
+    finally:
+        _KW_DB[2].put(scratch)
+
+def _find_sql_start(text: str) -> int:
+    """
+    Finds where the SQL starts: the earliest standalone SQL keyword followed by whitespace at
+    the start of a line (after optional spaces, a markdown fence or "SQL:"), so that prose
+    such as "Let me select the columns." before the query is skipped. Only if no line starts
+    with a keyword is the earliest inline one used. Word boundaries, whitespace and case
+    folding are ASCII-only, as in Hyperscan, so both paths agree.
+
+    Args:
+        text (str): The model output with any reasoning already removed.
+
+    Returns:
+        int: The index of the keyword in `text`, or -1 if there is none.
+    """
+    if _KW_DB is not None:
+        # One pass over the bytes for all patterns at once. Matches are reported in order of
+        # their end, and keyword matches cannot overlap, so the first one of each kind is the
+        # earliest; the scan stops at the first line-start keyword
+        data = text.encode('utf-8')
+        line_hits, inline_hits = [], []
+
+        def on_match(pattern_id, _start, end, _flags, _ctx):
+            if pattern_id < len(_SQL_KW):
+                line_hits.append(end - len(_SQL_KW[pattern_id]) - 1)
+                return True
+            inline_hits.append(end - len(_INLINE_SQL_KW[pattern_id - len(_SQL_KW)]) - 1)
+            return False
+
+        with _keyword_scratch() as scratch:
+            try:
+                _KW_DB[0].scan(data, match_event_handler=on_match, scratch=scratch)
+            except hyperscan.ScanTerminated:
+                pass
+        hits = line_hits or inline_hits
+        if not hits:
+            return -1
+        # Byte offset -> str index
+        return hits[0] if text.isascii() else len(data[:hits[0]].decode('utf-8'))
+
+    # Fallback: lower-case once and str.find each keyword
+    lo = text.translate(_ASCII_LOWER)
+    n = len(lo)
+    line_idx = inline_idx = -1
+    for kw in _SQL_KW:
+        i = lo.find(kw)
+        while i != -1 and (line_idx == -1 or i < line_idx):
+            after = i + len(kw)
+            before = lo[i - 1] if i else ''
+            if not (before.isascii() and (before.isalnum() or before == '_')) and after < n and lo[after] in ' \t\n\v\f\r':
+                if lo[lo.rfind('\n', 0, i) + 1:i].strip(' \t') in _LINE_PREFIXES:
+                    line_idx = i
+                    break
+                if kw in _INLINE_SQL_KW and (inline_idx == -1 or i < inline_idx):
+                    inline_idx = i
+            i = lo.find(kw, after)
+    return line_idx if line_idx != -1 else inline_idx
+
+def _extract_sql(text: str) -> str:
+    """
+    Extracts the first SQL statement from raw LLM output with plain string scanning.
+
+    Args:
+        text (str): The raw model output, possibly containing a <think> block,
+            markdown fences, "SQL:" prefixes or surrounding prose.
+
+    Returns:
+        str: The SQL statement terminated with a semicolon, or an empty string if none is found.
+    """
+    # 1. Thinking is disabled, but Qwen3 still emits an empty <think></think> block and may
+    #    ignore /no_think; everything up to the last closing tag is reasoning
+    close = text.lower().rfind('</think>')
+    if close != -1:
+        text = text[close + len('</think>'):]
+
+    # 2. Find the earliest standalone SQL keyword followed by whitespace.
+    #    Anything before it (markdown fences, "SQL:" prefixes, prose) is discarded.
+    idx = _find_sql_start(text)
+    if idx == -1:
+        return ""
+
+    # 3. Slice up to the first ';' (inclusive), closing fence or blank line, whichever comes first
+    stop = len(text)
+    semi = text.find(';', idx)
+    if semi != -1:
+        stop = semi + 1
+    for terminator in ('```', '\n\n'):
+        t = text.find(terminator, idx, stop)
+        if t != -1:
+            stop = t
+
+    final_sql = text[idx:stop].strip()
+    if not final_sql.endswith(';'):
+        final_sql += ";"
+    return final_sql
+
+# --- 3. Functions to Generate SQL using Qwen3-8B via llama-server ---
+def _build_messages(natural_language_query: str) -> list[dict]:
+    """
+    Builds the chat messages sent to Qwen3-8B for a single question.
 
     Args:
         natural_language_query (str): The user's natural language question.
-        db_schema (str): The database schema (DDL or descriptive text) to guide the LLM.
+
+    Returns:
+        list[dict]: The chat messages in OpenAI's format.
+    """
+
+    # Static instructions + schema first, the question (the only part that changes) last;
+    # the trailing "SQL:" cue makes the model answer with the statement straight away
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT_WITH_SCHEMA},
+        {"role": "user", "content": "Question: " + natural_language_query + "\nSQL:"}
+    ]
+
+def _stream_until_sql(messages: list[dict]) -> str:
+    """
+    Streams the model output, which the server ends at the first ';' stop sequence.
+    Partial output is shown in a placeholder while tokens come in.
+
+    Args:
+        messages (list[dict]): The chat messages in OpenAI's format.
+
+    Returns:
+        str: The raw model output, without the terminating semicolon.
+    """
+    placeholder = st.empty()
+    buf = ""
+    try:
+        for chunk in get_client().chat.completions.create(model=LLM_MODEL, messages=messages, stream=True, **_LLM_OPTIONS):
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            buf += chunk.choices[0].delta.content
+            placeholder.code(buf, language="text")
+    finally:
+        placeholder.empty()
+    return buf
+
+class _SQLNotFoundError(ValueError):
+    """Raised when the model output contains no SQL statement, so the miss is not cached."""
+
+def _generate_sql_cached(natural_language_query: str) -> str:
+    """
+    Returns the SQL for a question from the in-process or on-disk cache, calling Qwen3-8B
+    on a miss. Only the SQL string is cached: the streaming placeholder stays outside any
+    st.cache_data function, so a cache hit does not replay the token-by-token updates.
+    Failures are not cached, so they can be retried.
+
+    Raises:
+        _SQLNotFoundError: If the model output contains no SQL statement.
+    """
+    key = _cache_key(natural_language_query)
+    cached_sql = _load_cached_sql(key)
+    if cached_sql:
+        return cached_sql
+
+    messages = _build_messages(natural_language_query)
+    raw_llm_output = _stream_until_sql(messages).strip()
+
+    # --- Robust Post-processing to extract ONLY SQL ---
+    # Strips the <think> block, markdown fences and "SQL:" prefixes, then slices out the first statement.
+    final_sql = _extract_sql(raw_llm_output)
+    if not final_sql:
+        raise _SQLNotFoundError(natural_language_query)
+
+    _store_cached_sql(key, final_sql)
+    return final_sql
+
+def generate_sql_qwen(natural_language_query: str) -> str:
+    """
+    Generates a SQL query from a natural language query using Qwen3-8B via llama-server.
+    Includes stronger prompt engineering and robust post-processing to extract only SQL.
+    Results are cached across reruns and in SQL_CACHE_PATH, so repeated questions skip the LLM.
+
+    Args:
+        natural_language_query (str): The user's natural language question about the products table.
 
     Returns:
         str: The generated SQL query. Returns an empty string if an error occurs or SQL is not found.
     """
+    try:
+        return _generate_sql_cached(natural_language_query)
 
-    # --- REVISED PROMPT: Stronger directives to only output SQL ---
-    prompt_template = f"""
-    You are an expert SQL generator.
-    Your ONLY task is to convert natural language questions into accurate SQL queries.
-    You MUST respond with *only* the SQL query.
-    Do NOT include any explanations, internal thoughts, conversational text, markdown formatting (like ```sql), or any other text before or after the SQL.
-    Your response should be *solely* the SQL query.
+    except _SQLNotFoundError:
+        return ""
 
-    Here is the database schema:
-    {db_schema}
+    except Exception as e:
+        st.error(f"Error communicating with llama-server or Qwen3-8B: {e}")
+        st.info(f"Please ensure `llama-server` is running at {LLM_BASE_URL} with the Qwen3-8B GGUF model loaded.")
+        return ""
 
-    Question: {natural_language_query}
-    SQL:
+def _build_batch_messages(questions: list[str]) -> list[dict]:
     """
+    Builds one chat request that asks for the SQL of several questions as a JSON object.
+    The system prompt is the same as for single questions, so its KV-cache is shared.
+
+    Args:
+        questions (list[str]): The user's natural language questions.
 
-    messages = [
-        {"role": "user", "content": prompt_template}
+    Returns:
+        list[dict]: The chat messages in OpenAI's format.
+    """
+    numbered = "\n".join(f"{n}) {q}" for n, q in enumerate(questions, start=1))
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT_WITH_SCHEMA},
+        {"role": "user", "content": (
+            'Return a JSON object {"queries": ["SQL1;", "SQL2;", ...]} with exactly one SQL query '
+            "per question, in the same order, for the following questions:\n" + numbered
+        )}
     ]
 
+def generate_sql_qwen_many(questions: list[str]) -> list[str]:
+    """
+    Generates SQL for several questions with a single llama-server request that returns
+    a JSON array of queries, so the HTTP round-trip and prompt prefill are paid once.
+    Questions already in the on-disk cache are left out of the request. If the model returns
+    a different number of queries than it was asked for, the questions are asked one at a time.
+
+    Args:
+        questions (list[str]): The user's natural language questions about the products table.
+
+    Returns:
+        list[str]: One generated SQL query per question, in order. Entries are empty strings
+            where the request failed or no SQL was found.
+    """
+    keys = [_cache_key(q, 'batch') for q in questions]
+    generated = [_load_cached_sql(key) or "" for key in keys]
+    misses = [i for i, sql in enumerate(generated) if not sql]
+    if not misses:
+        return generated
+
+    messages = _build_batch_messages([questions[i] for i in misses])
+    try:
+        # No ';' stop sequence here: every query in the array ends with one
+        response = get_client().chat.completions.create(
+            model=LLM_MODEL,
+            messages=messages,
+            response_format={"type": "json_object"},
+            max_tokens=_LLM_OPTIONS['max_tokens'] * len(misses),
+            temperature=_LLM_OPTIONS['temperature'],
+            extra_body=_LLM_OPTIONS['extra_body'],
+        )
+        content = response.choices[0].message.content
+    except Exception as e:
+        st.error(f"Error communicating with llama-server or Qwen3-8B: {e}")
+        st.info(f"Please ensure `llama-server` is running at {LLM_BASE_URL} with the Qwen3-8B GGUF model loaded.")
+        return generated
+
+    # The server answered; anything wrong from here on is the shape of the model's output
+    try:
+        queries = json.loads(content)['queries']
+        if not isinstance(queries, list):
+            raise TypeError(f"'queries' is a {type(queries).__name__}, not a list")
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        st.error(f"Malformed response from Qwen3-8B, expected a JSON object with a 'queries' list: {e}")
+        return generated
+
+    if len(queries) != len(misses):
+        # A dropped or merged question shifts every later query onto the wrong question,
+        # so none of them is used or cached; each question is asked on its own instead
+        st.warning(f"Expected {len(misses)} queries from the model but got {len(queries)}; asking one question at a time.")
+        for i in misses:
+            generated[i] = generate_sql_qwen(questions[i])
+        return generated
+
+    for i, raw_sql in zip(misses, queries):
+        if not isinstance(raw_sql, str):
+            continue
+        generated[i] = _extract_sql(raw_sql)
+        if generated[i]:
+            _store_cached_sql(keys[i], generated[i])
+    return generated
+
+# --- 4. Functions to Execute SQL and Display Results ---
+@st.cache_resource
+def get_conn() -> duckdb.DuckDBPyConnection:
+    """
+    Opens an in-process DuckDB database once per server process and exposes the SQLite
+    `products` table to it as a view, so aggregate queries run on DuckDB's vectorized engine.
+    Each query uses its own cursor, which is DuckDB's way of sharing a database across threads.
+    The SQLite file is attached read-only, then file and network access is switched off and
+    the configuration locked, so generated SQL cannot read other files or undo the settings.
+
+    Returns:
+        duckdb.DuckDBPyConnection: The shared DuckDB connection.
+    """
+    c = duckdb.connect()
+    c.execute("INSTALL sqlite; LOAD sqlite;")
+    sqlite_path = DB_PATH.replace("'", "''")
+    c.execute(f"ATTACH '{sqlite_path}' AS src (TYPE sqlite, READ_ONLY)")
+    c.execute("CREATE VIEW products AS SELECT * FROM src.products")
+    c.execute("SET enable_external_access = false")
+    c.execute("SET lock_configuration = true")
+    return c
+
+_AGG_RE = re.compile(r'^(sum|count|avg|max|min)\((.+)\)$', re.IGNORECASE)
+_AGG_LABEL = {'sum': 'Total', 'count': 'Number of', 'avg': 'Average', 'max': 'Maximum', 'min': 'Minimum'}
+_DUCKDB_ALIASES = {'count_star()': 'count(*)'}
+
+def _clean_column_name(col: str) -> str:
+    """
+    Turns a raw result column name such as `SUM(stock_quantity)` into a display label.
+
+    Args:
+        col (str): The column name reported by DuckDB.
+
+    Returns:
+        str: The human-readable column label.
+    """
+    col = _DUCKDB_ALIASES.get(col.lower(), col)
+    m = _AGG_RE.match(col)
+    if m:
+        return f"{_AGG_LABEL[m.group(1).lower()]} {m.group(2).replace('_', ' ').title()}"
+    return col.replace('_', ' ').title()
+
+# Tables generated SQL may read from; CTEs defined in the query itself are allowed too
+_QUERYABLE_TABLES = frozenset({'products'})
+
+# Column types of the SQLite schema the model sees, for sqlglot's type inference
+_SQLITE_SCHEMA = {
+    create.this.this.name: {col.name: col.args['kind'].sql() for col in create.this.find_all(exp.ColumnDef)}
+    for create in sqlglot.parse(DB_SCHEMA_PRODUCTS, dialect='sqlite')
+    if isinstance(create, exp.Create)
+}
+
+def _annotate_scalar_subquery(annotator, subquery: exp.Subquery) -> exp.Subquery:
+    # sqlglot leaves `(SELECT COUNT(*) ...)` untyped; a one-column subquery has its column's type.
+    # Inner scopes are annotated first, so the projection is already typed here.
+    selects = subquery.selects
+    subquery.type = selects[0].type if len(selects) == 1 else exp.DataType.Type.UNKNOWN
+    return subquery
+
+_SQLITE_ANNOTATORS = {
+    **sqlglot.Dialect.get_or_raise('sqlite').ANNOTATORS,
+    exp.Subquery: _annotate_scalar_subquery,
+}
+
+def _keep_sqlite_semantics(tree: exp.Expression) -> exp.Expression:
+    """
+    Rewrites the SQLite constructs that mean something else in DuckDB:
+    LIKE is case-insensitive in SQLite (ILIKE in DuckDB), `/` between two integers
+    truncates in SQLite (`//` in DuckDB) while DuckDB's `/` always returns a float,
+    REAL/FLOAT is a 64-bit double in SQLite but 32-bit in DuckDB, SUM over integers is
+    an integer in SQLite but a HUGEINT in DuckDB, which pandas turns into a float, and
+    CAST(<real> AS INTEGER) truncates in SQLite but rounds in DuckDB.
+    Known gaps: SQLite-only functions such as TOTAL() or strftime(..., 'now') are passed
+    through and fail on DuckDB with an error, and a node whose types cannot be inferred
+    is left as DuckDB reads it.
+
+        >>> validate_read_only_sql("SELECT SUM(stock_quantity) FROM products")
+        'SELECT CAST(SUM(stock_quantity) AS BIGINT) AS "SUM(stock_quantity)" FROM products'
+        >>> validate_read_only_sql("SELECT CAST(SUM(stock_quantity) AS REAL)/COUNT(*) FROM products")
+        'SELECT CAST(CAST(SUM(stock_quantity) AS BIGINT) AS DOUBLE) / COUNT(*) FROM products'
+        >>> validate_read_only_sql("SELECT COUNT(*) * 100 / (SELECT COUNT(*) FROM products) FROM products WHERE price > 100")
+        'SELECT COUNT(*) * 100 // (SELECT COUNT(*) FROM products) FROM products WHERE price > 100'
+        >>> validate_read_only_sql("SELECT category, SUM(stock_quantity)/COUNT(*) AS avg_stock FROM products GROUP BY category ORDER BY SUM(stock_quantity)/COUNT(*) DESC")
+        'SELECT category, CAST(SUM(stock_quantity) AS BIGINT) // COUNT(*) AS avg_stock FROM products GROUP BY category ORDER BY CAST(SUM(stock_quantity) AS BIGINT) // COUNT(*) DESC'
+
+    Args:
+        tree (exp.Expression): The parsed SQLite query; it is modified in place.
+
+    Returns:
+        exp.Expression: The same tree, ready to be generated for DuckDB.
+    """
+    for like in list(tree.find_all(exp.Like)):
+        like.replace(exp.ILike(this=like.this, expression=like.expression))
+
+    for data_type in list(tree.find_all(exp.DataType)):
+        if data_type.this == exp.DataType.Type.FLOAT:
+            data_type.replace(exp.DataType.build('DOUBLE'))
+
+    casts = [c for c in tree.find_all(exp.Cast) if c.to.is_type(*exp.DataType.INTEGER_TYPES)]
+    nodes = [*tree.find_all(exp.Div, exp.Sum, bfs=False), *casts]
+    if not nodes:
+        return tree
+    for tag, node in enumerate(nodes):
+        node.meta['sqlite_tag'] = tag
     try:
-        response = ollama.chat(model='qwen3:8b', messages=messages, stream=False)
-        raw_llm_output = response['message']['content'].strip()
-
-        # --- Robust Post-processing to extract ONLY SQL ---
-        # This regex attempts to find and extract the SQL query by looking for common SQL keywords
-        # at the start of a line, and then captures everything until a semicolon or the end of the string.
-        # It handles potential markdown blocks and common LLM "thought" patterns like <think>.
-
-        # 1. Aggressively remove common LLM "thought" tags and code block delimiters
-        cleaned_output = re.sub(r'</?think>', '', raw_llm_output, flags=re.IGNORECASE).strip()
-        # Remove markdown fences and "SQL:" prefix if present
-        cleaned_output = re.sub(r'^(```sql|```|SQL:)\s*', '', cleaned_output, flags=re.IGNORECASE|re.MULTILINE).strip()
-
-
-        # 2. Attempt to find the SQL statement using regex
-        # This regex looks for lines starting with common SQL DML/DDL keywords
-        # and captures content until a semicolon, the end of string, or a blank line.
-        sql_match = re.search(
-            r'^(SELECT|INSERT|UPDATE|DELETE|CREATE|ALTER|DROP)\s+.*?(;|$)',
-            cleaned_output,
-            re.IGNORECASE | re.DOTALL | re.MULTILINE
+        # Types are inferred on a qualified copy, which keeps the tags. Qualifying can drop
+        # nodes (ORDER BY SUM(x) becomes ORDER BY the projection's alias), so nodes are
+        # matched by tag and not by position
+        typed = annotate_types(
+            qualify(tree.copy(), schema=_SQLITE_SCHEMA, dialect='sqlite',
+                    expand_stars=False, expand_alias_refs=False, validate_qualify_columns=False),
+            schema=_SQLITE_SCHEMA,
+            annotators=_SQLITE_ANNOTATORS,
         )
+    except sqlglot.errors.SqlglotError:
+        # Nothing can be typed; every node falls back below
+        typed_by_tag = {}
+    else:
+        typed_by_tag = {n.meta['sqlite_tag']: n for n in typed.find_all(exp.Div, exp.Sum, exp.Cast) if 'sqlite_tag' in n.meta}
+    pairs = []
+    for node in nodes:
+        typed_node = typed_by_tag.get(node.meta['sqlite_tag'])
+        if typed_node is None:
+            # A node dropped by qualify repeats a projection; borrow that one's types
+            typed_node = next((typed_by_tag[other.meta['sqlite_tag']] for other in nodes
+                               if other is not node and other.meta['sqlite_tag'] in typed_by_tag and other == node), None)
+        pairs.append((node, typed_node))
+
+    for node, typed_node in pairs:
+        node.meta.pop('sqlite_tag')
+        if typed_node is None:
+            # Untyped: left as DuckDB would read it
+            continue
+        if isinstance(node, exp.Cast):
+            if typed_node.this.is_type(*exp.DataType.REAL_TYPES):
+                # SQLite truncates toward zero where DuckDB rounds
+                operand, trunc = node.this, exp.Anonymous(this='TRUNC')
+                operand.replace(trunc)
+                trunc.set('expressions', [operand])
+        elif isinstance(node, exp.Div):
+            if typed_node.left.is_type(*exp.DataType.INTEGER_TYPES) and typed_node.right.is_type(*exp.DataType.INTEGER_TYPES):
+                node.replace(exp.IntDiv(this=node.this, expression=node.expression))
+        elif typed_node.this.is_type(*exp.DataType.INTEGER_TYPES):
+            # Cast the whole aggregate, including any OVER/FILTER clause attached to it
+            target = node
+            while isinstance(target.parent, (exp.Window, exp.Filter)):
+                target = target.parent
+            projection = isinstance(target.parent, exp.Select) and target.arg_key == 'expressions'
+            name = target.sql(dialect='duckdb')
+            # Wrapped in place rather than copied, so nodes later in the list stay in the tree
+            cast = exp.Cast(to=exp.DataType.build('BIGINT'))
+            # Keep the column name DuckDB would have given the bare aggregate
+            target.replace(exp.alias_(cast, name, quoted=True, copy=False) if projection else cast)
+            cast.set('this', target)
+    return tree
+
+def validate_read_only_sql(generated_sql: str) -> str:
+    """
+    Parses the generated SQL with sqlglot and only lets a single read-only query through,
+    so a DROP/DELETE/UPDATE from the model never reaches the database. The query may only
+    read the tables in _QUERYABLE_TABLES (or its own CTEs): table functions such as
+    read_csv() or sqlite_scan(), file paths and schema-qualified names are rejected.
+    The model writes SQLite SQL (it sees the SQLite schema); the query is transpiled for DuckDB
+    with SQLite's LIKE and integer-division semantics kept.
+
+    Args:
+        generated_sql (str): The SQL query produced by the LLM.
+
+    Returns:
+        str: The query rewritten by sqlglot for the DuckDB dialect.
+
+    Raises:
+        ValueError: If the SQL is not exactly one SELECT (or UNION/WITH ... SELECT) statement,
+            or reads from anything other than the allowed tables.
+        sqlglot.errors.SqlglotError: If the SQL cannot be tokenized or parsed.
+    """
+    statements = [tree for tree in sqlglot.parse(generated_sql, dialect='sqlite') if tree is not None]
+    if len(statements) != 1:
+        raise ValueError(f"Expected exactly one SQL statement, got {len(statements)}.")
+    if not isinstance(statements[0], exp.Query):
+        raise ValueError(f"Only read-only SELECT queries are allowed, got {statements[0].key.upper()}.")
+    tree = statements[0]
+    allowed = _QUERYABLE_TABLES | {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    for source in tree.find_all(exp.Table, exp.Unnest, exp.Lateral, exp.UDTF):
+        if not isinstance(source, exp.Table) or not isinstance(source.this, exp.Identifier):
+            raise ValueError("Table functions are not allowed in the FROM clause.")
+        if source.args.get('db') or source.args.get('catalog') or source.name.lower() not in allowed:
+            raise ValueError(f"Only the {', '.join(sorted(_QUERYABLE_TABLES))} table can be queried, got {source.sql()}.")
+    return _keep_sqlite_semantics(tree).sql(dialect='duckdb')
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def run_query(sql: str) -> pd.DataFrame:
+    """
+    Executes a validated query on DuckDB and caches the result by SQL text, so reruns of the
+    script do not hit the database again.
+
+    Args:
+        sql (str): The read-only SQL query to execute.
 
-        final_sql = ""
-        if sql_match:
-            final_sql = sql_match.group(0).strip()
-            # Ensure it ends with a semicolon if it's a full statement
-            if not final_sql.endswith(';'):
-                final_sql += ";"
+    Returns:
+        pd.DataFrame: The query results with the raw column names.
+    """
+    # A cursor per query, closed afterwards; the shared connection stays open
+    with get_conn().cursor() as cur:
+        return cur.execute(sql).fetchdf()
+
+def display_query_results(generated_sql: str) -> None:
+    """
+    Runs the generated SQL against the local database and renders the results.
+
+    Args:
+        generated_sql (str): The SQL query to execute.
+    """
+    st.subheader("Generated SQL:")
+    st.code(generated_sql, language="sql")
+
+    try:
+        safe_sql = validate_read_only_sql(generated_sql)
+    except (ValueError, sqlglot.errors.SqlglotError) as validation_error:
+        st.error(f"Refusing to run the generated SQL: {validation_error}")
+        return
+
+    try:
+        get_conn()
+    except duckdb.Error as setup_error:
+        # Not the query's fault: the connection is retried on the next run
+        st.error(f"Could not set up the DuckDB connection to '{DB_FILE}': {setup_error}")
+        st.info("DuckDB downloads its sqlite extension on first use, so the first run needs network access.")
+        return
+
+    try:
+        df = run_query(safe_sql)
+
+        st.subheader("Query Results:")
+        if not df.empty:
+            # --- Clean Column Names for Display ---
+            pretty_names = {col: _clean_column_name(col) for col in df.columns}
+            df = df.rename(columns=pretty_names)
+            st.dataframe(df, use_container_width=True)
         else:
-            # Fallback if regex doesn't match: try to find the first line starting with a SQL keyword
-            # This is less robust but might catch some cases.
-            sql_keywords = ['select', 'insert', 'update', 'delete', 'create', 'alter', 'drop']
-            potential_lines = cleaned_output.split('\n')
-            for i, line in enumerate(potential_lines):
-                if line.strip().lower().startswith(tuple(sql_keywords)):
-                    # Assume this line and possibly subsequent non-empty lines are the SQL
-                    temp_sql_lines = [line.strip()]
-                    for j in range(i + 1, len(potential_lines)):
-                        if potential_lines[j].strip():
-                            temp_sql_lines.append(potential_lines[j].strip())
-                        else:
-                            break # Stop at first blank line
-                    final_sql = " ".join(temp_sql_lines).strip()
-                    break # Stop after finding the first potential SQL
-
-        # Final check to ensure semicolon and remove any remaining trailing markdown if LLM misbehaves
-        if final_sql and final_sql.endswith('```'):
-            final_sql = final_sql[:-3].strip()
-        if final_sql and not final_sql.endswith(';') and final_sql.lower().startswith(tuple(sql_keywords)):
-             final_sql += ";"
-
-
-        return final_sql
+            st.info("No results found for this query or the query returned an empty set.")
 
-    except Exception as e:
-        st.error(f"Error communicating with Ollama or Qwen3:8B: {e}")
-        st.info("Please ensure Ollama is running and the 'qwen3:8b' model is downloaded (`ollama run qwen3:8b`).")
-        return ""
+    except duckdb.Error as db_error:
+        st.error(f"Error executing SQL query against database: {db_error}")
+        st.warning("The generated SQL might be incorrect or incompatible with the database schema.")
 
-# --- 4. Streamlit User Interface Setup ---
+# --- 5. Streamlit User Interface Setup ---
 st.title("🛍️ Natural Language to SQL Product Query (Local Qwen3)")
 st.write("Ask questions about your `products.db` database in plain English!")
 
+with st.sidebar:
+    st.subheader("Batch questions")
+    st.write(
+        "Enter one question per line to generate SQL for all of them in a single request. "
+        "The model returns a JSON array of queries, so the instructions and schema are processed only once."
+    )
+    if st.button("Clear SQL cache"):
+        clear_sql_cache()
+        st.success("Cached SQL cleared.")
+
 if not os.path.exists(DB_PATH):
     st.error(f"Database file '{DB_FILE}' not found at '{DB_PATH}'.")
     st.info("Please run the `db.py` script first to create and populate the database.")
     st.stop()
 
-user_question = st.text_input(
-    "Enter your question:",
+user_input = st.text_area(
+    "Enter your question (one per line):",
     "What is the total stock quantity of all products?",
     key="user_question_input"
 )
+user_questions = [q.strip() for q in user_input.splitlines() if q.strip()]
 
-if user_question:
+if user_questions:
     with st.spinner("Thinking... Generating SQL and fetching data..."):
         try:
-            generated_sql = generate_sql_qwen(user_question, DB_SCHEMA_PRODUCTS)
-
-            if generated_sql:
-                st.subheader("Generated SQL:")
-                st.code(generated_sql, language="sql")
-
-                conn = None
-                try:
-                    conn = sqlite3.connect(DB_PATH)
-                    cursor = conn.cursor()
-                    cursor.execute(generated_sql)
-                    results = cursor.fetchall()
-
-                    st.subheader("Query Results:")
-                    if results:
-                        col_names = [description[0] for description in cursor.description]
-
-                        # --- Clean Column Names for Display ---
-                        cleaned_col_names = []
-                        for col in col_names:
-                            if col.lower().startswith('sum(') and col.endswith(')'):
-                                field = col[len('sum('):-1]
-                                cleaned_col_names.append(f"Total {field.replace('_', ' ').title()}")
-                            elif col.lower().startswith('count(') and col.endswith(')'):
-                                field = col[len('count('):-1]
-                                cleaned_col_names.append(f"Number of {field.replace('_', ' ').title()}")
-                            elif col.lower().startswith('avg(') and col.endswith(')'):
-                                field = col[len('avg('):-1]
-                                cleaned_col_names.append(f"Average {field.replace('_', ' ').title()}")
-                            elif col.lower().startswith('max(') and col.endswith(')'):
-                                field = col[len('max('):-1]
-                                cleaned_col_names.append(f"Maximum {field.replace('_', ' ').title()}")
-                            elif col.lower().startswith('min(') and col.endswith(')'):
-                                field = col[len('min('):-1]
-                                cleaned_col_names.append(f"Minimum {field.replace('_', ' ').title()}")
-                            else:
-                                cleaned_col_names.append(col.replace('_', ' ').title())
-
-                        df = pd.DataFrame(results, columns=cleaned_col_names)
-                        st.dataframe(df, use_container_width=True)
-                    else:
-                        st.info("No results found for this query or the query returned an empty set.")
-
-                except sqlite3.Error as db_error:
-                    st.error(f"Error executing SQL query against database: {db_error}")
-                    st.warning("The generated SQL might be incorrect or incompatible with the database schema.")
-                finally:
-                    if conn:
-                        conn.close()
+            if len(user_questions) == 1:
+                generated_sqls = [generate_sql_qwen(user_questions[0])]
             else:
-                st.warning("SQL generation failed. Please try a different question or check Ollama server status.")
+                generated_sqls = generate_sql_qwen_many(user_questions)
+
+            for user_question, generated_sql in zip(user_questions, generated_sqls):
+                if len(user_questions) > 1:
+                    st.markdown(f"#### {user_question}")
+
+                if generated_sql:
+                    display_query_results(generated_sql)
+                else:
+                    st.warning("SQL generation failed. Please try a different question or check llama-server status.")
 
         except Exception as e:
             st.error(f"An unexpected error occurred: {e}")
             st.info("Please review your console for more details and ensure all prerequisites are met.")
 
 st.markdown("---")
-st.caption("Powered by Ollama (Qwen3:8B) and Streamlit. Ensure Ollama is running and `qwen3:8b` is downloaded.")
\ No newline at end of file
+st.caption("Powered by llama.cpp (Qwen3-8B Q4_K_M) and Streamlit. Ensure `llama-server` is running with the model loaded.")
\ No newline at end of file
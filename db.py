@@ -5,15 +5,10 @@ import os
 DB_FILE = 'products.db'
 DB_PATH = os.path.join(os.getcwd(), DB_FILE)
 
-# If the database file already exists, remove it (for a clean start each time)
-if os.path.exists(DB_PATH):
-    os.remove(DB_PATH)
-    print(f"Existing database '{DB_FILE}' removed.")
-
-# Create the SQLAlchemy engine for SQLite
-# The 'sqlite:///' prefix indicates a SQLite database
-# f"sqlite:///{DB_FILE}" creates a database file named 'products.db' in your project root
-engine = create_engine(f"sqlite:///{DB_FILE}")
+# Create the SQLAlchemy engine for an in-memory SQLite database
+# Every statement below only touches RAM; the finished database is written to
+# 'products.db' in your project root in one sequential pass at the end
+engine = create_engine("sqlite:///:memory:")
 
 # Connect to the database and execute SQL commands
 with engine.connect() as connection:
@@ -30,22 +25,39 @@ with engine.connect() as connection:
     connection.execute(text(create_table_sql))
     print("Table 'products' created successfully.")
 
-    # Insert some sample data
+    # Insert some sample data with one parameterized statement executed for all rows
+    rows = [
+        {'product_name': 'Laptop Pro', 'category': 'Electronics', 'price': 1200.00, 'stock_quantity': 50},
+        {'product_name': 'Mechanical Keyboard', 'category': 'Electronics', 'price': 150.00, 'stock_quantity': 120},
+        {'product_name': 'Wireless Mouse', 'category': 'Accessories', 'price': 35.50, 'stock_quantity': 300},
+        {'product_name': 'USB-C Hub', 'category': 'Accessories', 'price': 50.00, 'stock_quantity': 80},
+        {'product_name': 'Monitor 27-inch', 'category': 'Electronics', 'price': 300.00, 'stock_quantity': 70},
+        {'product_name': 'Ergonomic Chair', 'category': 'Furniture', 'price': 350.00, 'stock_quantity': 30},
+        {'product_name': 'Webcam Full HD', 'category': 'Accessories', 'price': 75.00, 'stock_quantity': 90},
+    ]
     insert_data_sql = """
-    INSERT INTO products (product_name, category, price, stock_quantity) VALUES
-    ('Laptop Pro', 'Electronics', 1200.00, 50),
-    ('Mechanical Keyboard', 'Electronics', 150.00, 120),
-    ('Wireless Mouse', 'Accessories', 35.50, 300),
-    ('USB-C Hub', 'Accessories', 50.00, 80),
-    ('Monitor 27-inch', 'Electronics', 300.00, 70),
-    ('Ergonomic Chair', 'Furniture', 350.00, 30),
-    ('Webcam Full HD', 'Accessories', 75.00, 90);
+    INSERT INTO products (product_name, category, price, stock_quantity)
+    VALUES (:product_name, :category, :price, :stock_quantity);
     """
-    connection.execute(text(insert_data_sql))
+    connection.execute(text(insert_data_sql), rows)
     print("Sample data inserted into 'products' table.")
 
+    # Index the columns generated queries filter and group on; building them after the
+    # inserts keeps them inside the same transaction
+    connection.execute(text("CREATE INDEX idx_category ON products(category);"))
+    connection.execute(text("CREATE INDEX idx_price ON products(price);"))
+    print("Indexes on 'category' and 'price' created.")
+
     # Commit the changes
     connection.commit()
 
+    # VACUUM INTO refuses to overwrite, so remove any previous database first (for a clean start each time)
+    if os.path.exists(DB_PATH):
+        os.remove(DB_PATH)
+        print(f"Existing database '{DB_FILE}' removed.")
+
+    # Dump the in-memory database to disk
+    connection.execute(text("VACUUM INTO :path"), {"path": DB_PATH})
+
 print(f"Database '{DB_FILE}' created and populated at {DB_PATH}")
 print("Database setup complete!")
\ No newline at end of file